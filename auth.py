@@ -1,30 +1,64 @@
 import os
 import logging
+import threading
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly", "https://www.googleapis.com/auth/gmail.compose","https://www.googleapis.com/auth/userinfo.profile"]
+
+_CACHED_CREDS = None
+_CREDS_LOCK = threading.Lock()
+# httplib2 (used by googleapiclient) is not thread-safe, so built services are cached per thread.
+_SERVICE_CACHE = threading.local()
 
 def authorize():
-    SCOPES = ["https://www.googleapis.com/auth/gmail.readonly", "https://www.googleapis.com/auth/gmail.compose","https://www.googleapis.com/auth/userinfo.profile"]
-    creds = None
-    try:
-        if os.path.exists("token.json"):
-            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-                creds = flow.run_local_server(port=0)
-            with open("token.json", "w") as token:
-                token.write(creds.to_json())
-    except HttpError as e:
-        logging.error(f"HTTP error during authorization: {e.resp.status} - {e.content.decode()}")
-        creds = None
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during authorization: {e}")
-        creds = None
-    return creds
\ No newline at end of file
+    global _CACHED_CREDS
+    creds = _CACHED_CREDS
+    if creds and creds.valid:
+        return creds
+    with _CREDS_LOCK:
+        # Another thread may have refreshed the credentials while we waited for the lock.
+        creds = _CACHED_CREDS
+        if creds and creds.valid:
+            return creds
+        try:
+            if not creds and os.path.exists("token.json"):
+                creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+                    creds = flow.run_local_server(port=0)
+                with open("token.json", "w") as token:
+                    token.write(creds.to_json())
+        except HttpError as e:
+            logger.error(f"HTTP error during authorization: {e.resp.status} - {e.content.decode()}")
+            creds = None
+        except Exception as e:
+            logger.error(f"An unexpected error occurred during authorization: {e}")
+            creds = None
+        _CACHED_CREDS = creds
+    return creds
+
+def get_service(api, version):
+    """Returns a cached googleapiclient service for (api, version), building it on first use."""
+    creds = authorize()
+    if not creds:
+        return None
+    services = getattr(_SERVICE_CACHE, "services", None)
+    if services is None:
+        services = _SERVICE_CACHE.services = {}
+    cached = services.get((api, version))
+    # Refreshes update the credentials in place; a new object means a fresh OAuth flow ran.
+    if cached is None or cached[0] is not creds:
+        # static_discovery uses the discovery document bundled with googleapiclient instead of fetching it.
+        service = build(api, version, credentials=creds, cache_discovery=False, static_discovery=True)
+        cached = (creds, service)
+        services[(api, version)] = cached
+    return cached[1]
@@ -2,73 +2,256 @@ from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 import os
-from googleapiclient.discovery import build
 from google.genai.errors import APIError, ClientError
-from tenacity import retry, retry_if_exception_type, wait_exponential, stop_after_attempt
-import json
+from tenacity import Retrying, retry_if_exception, wait_exponential, stop_after_attempt
 import logging
+import asyncio
+import inspect
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
 
 
-from .tools import get_weather, add_draft, send_email, update_draft, list_drafts
-from .auth import authorize
+from pydantic import ValidationError
+
+from .tools import get_weather, add_draft, send_email, update_draft, list_drafts, close_weather_session, ToolInvocation
+from .auth import get_service
 
 load_dotenv()
 MODEL = os.getenv("MODEL")
+_GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+if not _GEMINI_API_KEY:
+    raise RuntimeError("GEMINI_API_KEY is not set. Add it to the .env file.")
+# Seconds to wait on a tool before handing the model a pending handle instead of the result.
+TOOL_RESULT_TIMEOUT = 10
+# Rough token budget for the conversation history; older turns are summarized once it is exceeded.
+CONTEXT_TOKEN_LIMIT = 6000
+CONTEXT_KEEP_TURNS = 4
+# Lifetime of the server-side cache holding the system prompt and tool declarations.
+CACHE_TTL_SECONDS = 3600
+# Smallest prompt Gemini will cache explicitly (1024 tokens for Flash models; Pro models need more).
+CACHE_MIN_TOKENS = 1024
+# Upper bound on consecutive tool-calling rounds the model may request within one user turn.
+MAX_TOOL_ROUNDS = 5
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type((APIError, ClientError))
-)
-def _function_calling_with_retry(contents, config):
-    """Helper function to call the model with retry logic."""
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=contents,
-        config=config
+_EMAIL_PROPERTIES = {
+    "to": types.Schema(type=types.Type.STRING, description="email address of the reciever"),
+    "subject": types.Schema(type=types.Type.STRING, description="subject of the email"),
+    "body": types.Schema(type=types.Type.STRING, description="actual body of the email")
+}
+
+# Tool definitions for the model, built once at import time.
+_FUNCTION_DECLARATIONS = [
+    types.FunctionDeclaration(
+        name="get_weather",
+        description="Returns weather information of a place.",
+        parameters=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "place": types.Schema(type=types.Type.STRING, description="Name of the place"),
+                "aqi": types.Schema(type=types.Type.BOOLEAN, description="True if aqi is asked else False.")
+            },
+            required=["place", "aqi"]
+        )
+    ),
+    types.FunctionDeclaration(
+        name="add_draft",
+        description="Adds the draft into drafts",
+        parameters=types.Schema(
+            type=types.Type.OBJECT,
+            properties=_EMAIL_PROPERTIES,
+            required=["to", "subject", "body"]
+        )
+    ),
+    types.FunctionDeclaration(
+        name="send_email",
+        description="sends the email",
+        parameters=types.Schema(
+            type=types.Type.OBJECT,
+            properties=_EMAIL_PROPERTIES,
+            required=["to", "subject", "body"]
+        )
+    ),
+    types.FunctionDeclaration(
+        name="list_drafts",
+        description="returns a list of drafts"
+    ),
+    types.FunctionDeclaration(
+        name="update_draft",
+        description="Updates a pre-existing draft.",
+        parameters=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "draft_id": types.Schema(type=types.Type.STRING, description="Id of the draft to be updated."),
+                **_EMAIL_PROPERTIES
+            },
+            required=["draft_id", "to", "subject", "body"]
+        )
+    ),
+    types.FunctionDeclaration(
+        name="await_result",
+        description="Returns the result of a tool call that previously returned a pending handle.",
+        parameters=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "handle": types.Schema(type=types.Type.STRING, description="Handle returned by the pending tool call.")
+            },
+            required=["handle"]
+        )
+    ),
+    types.FunctionDeclaration(
+        name="batch_tool",
+        description="Invokes multiple other tools simultaneously and returns all of their results.",
+        parameters=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "invocations": types.Schema(
+                    type=types.Type.ARRAY,
+                    description="Tool calls to run in parallel.",
+                    items=types.Schema(
+                        type=types.Type.OBJECT,
+                        properties={
+                            "tool_name": types.Schema(type=types.Type.STRING, description="Name of the tool to invoke."),
+                            "arguments": types.Schema(type=types.Type.STRING, description="JSON object string with the arguments for the tool.")
+                        },
+                        required=["tool_name", "arguments"]
+                    )
+                )
+            },
+            required=["invocations"]
+        )
     )
-    return response
+]
+_TOOL = types.Tool(function_declarations=_FUNCTION_DECLARATIONS)
+
+def _is_retryable_model_error(error):
+    """API errors are retried unless part of the answer was already shown to the user."""
+    return isinstance(error, (APIError, ClientError)) and not getattr(error, "partial_output", False)
 
-@retry(
+# Built once and shared by both model helpers; tenacity keeps per-call state thread-local.
+_MODEL_RETRY = Retrying(
     stop=stop_after_attempt(2),
     wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type((APIError, ClientError))
+    retry=retry_if_exception(_is_retryable_model_error),
+    reraise=True
 )
-def _tool_response_with_retry(contents):
-    """Helper function to get tool responses with retry logic."""
-    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-    response = client.models.generate_content(
-        model=MODEL,
-        contents=contents
+
+_GENAI_CLIENT = None
+
+def _get_genai_client():
+    """Returns the shared Gemini client so its HTTP connection pool is reused across turns."""
+    global _GENAI_CLIENT
+    if _GENAI_CLIENT is None:
+        _GENAI_CLIENT = genai.Client(api_key=_GEMINI_API_KEY)
+    return _GENAI_CLIENT
+
+def _function_calling_with_retry(contents, config, on_text=None):
+    """Helper function to stream the model response with retry logic.
+
+    Answer text is passed to on_text as each chunk arrives; once any text has been emitted a
+    failed stream is not retried, so the user never sees the answer twice. The chunks are
+    merged into one response built on the last chunk that carries a candidate.
+    """
+    client = _get_genai_client()
+    for attempt in _MODEL_RETRY:
+        with attempt:
+            parts = []
+            last_chunk = None
+            last_candidate_chunk = None
+            emitted = False
+            try:
+                for chunk in client.models.generate_content_stream(
+                    model=MODEL,
+                    contents=contents,
+                    config=config
+                ):
+                    last_chunk = chunk
+                    if not chunk.candidates or not chunk.candidates[0].content:
+                        continue
+                    last_candidate_chunk = chunk
+                    for part in chunk.candidates[0].content.parts or []:
+                        if part.text and not part.thought and on_text:
+                            on_text(part.text)
+                            emitted = True
+                        # Stream chunks split text into fragments; join them so the history holds one part per message.
+                        if part.text is not None and parts and parts[-1].text is not None and parts[-1].thought == part.thought:
+                            update = {"text": parts[-1].text + part.text}
+                            if part.thought_signature:
+                                update["thought_signature"] = part.thought_signature
+                            parts[-1] = parts[-1].model_copy(update=update)
+                        else:
+                            parts.append(part)
+            except (APIError, ClientError) as e:
+                e.partial_output = emitted
+                raise
+    if last_candidate_chunk is None or not parts:
+        return last_chunk or types.GenerateContentResponse()
+    candidate = last_candidate_chunk.candidates[0].model_copy(
+        update={"content": types.Content(role="model", parts=parts)}
     )
+    update = {"candidates": [candidate]}
+    # Usage totals usually arrive on the final chunk, which may have no candidate.
+    if last_chunk.usage_metadata:
+        update["usage_metadata"] = last_chunk.usage_metadata
+    return last_candidate_chunk.model_copy(update=update)
+
+def _tool_response_with_retry(contents):
+    """Helper function to call the model without tools, with retry logic."""
+    client = _get_genai_client()
+    for attempt in _MODEL_RETRY:
+        with attempt:
+            response = client.models.generate_content(
+                model=MODEL,
+                contents=contents
+            )
     return response
 
 class Agent:
     def __init__(self):
-        self.contents = self._initialize_contents()
-        self.function_declarations = self._get_function_declarations()
-        self.tools = types.Tool(function_declarations=self.function_declarations)
-        self.config = types.GenerateContentConfig(tools=[self.tools])
+        # One long-lived event loop so async tool clients (e.g. the weather session) are reused across turns.
+        self.runner = asyncio.Runner()
+        self.user_profile = self._get_user_profile()
+        self.system_prompt = self._get_system_prompt(self.user_profile)
+        self.contents: list[types.Content] = []
+        # Running estimate of the history size, updated as contents are appended.
+        self.context_tokens = 0
+        self.tools = _TOOL
+        self.cache_name = None
+        self.cache_expire_time = None
+        self.config = self._create_config()
+        # Used to force a text answer once MAX_TOOL_ROUNDS is hit. Cached content cannot be combined
+        # with tool_config, so this config carries the system prompt and tools itself.
+        self.answer_config = types.GenerateContentConfig(
+            system_instruction=self.system_prompt,
+            tools=[self.tools],
+            tool_config=types.ToolConfig(
+                function_calling_config=types.FunctionCallingConfig(mode=types.FunctionCallingConfigMode.NONE)
+            )
+        )
         self.available_tools = {
             "get_weather": get_weather,
             "add_draft": add_draft,
             "send_email": send_email,
             "list_drafts": list_drafts,
-            "update_draft": update_draft
+            "update_draft": update_draft,
+            "await_result": self._await_result,
+            "batch_tool": self._batch_tool
         }
+        self.pending_results = {}
+        self.streamed_text = False
 
-    def _initialize_contents(self):
-        """Initializes the system prompt with user profile information."""
-        user_profile = self._get_user_profile()
+    def _get_system_prompt(self, user_profile):
+        """Builds the system prompt with user profile information."""
         system_prompt = f"""
         User profile is {user_profile}
         For multiple tasks in a single query, treat each task as a separate query.
+        When several tool calls are needed at once, prefer a single batch_tool call containing all of them.
         
         In case of using tool related to weather:
-        for each city/place mentioned, call the functions separately.
+        for multiple cities/places, call get_weather for each of them inside one batch_tool call.
         
         In case of using tool related to gmail:
         If the user asks for writing an email or drafting an email then always write an email first before calling any tool and get it checked by human.
@@ -82,151 +265,371 @@ class Agent:
         
         If the user asks for list of drafts, call list_drafts function and give user a list containing draft information like draft id, recipients, subject and body.
         If the user asks to update a pre-existing draft, before updating the draft, write a new email then ask user if its okay or not. If the user is okay with the new email call update_draft function and make sure that you have draft id.
+        
+        If a tool returns a result with status "pending" and a handle, the tool is still running. Tell the user it is in progress and call await_result with that handle to get the result.
         """
-        return [("system", system_prompt)]
-
-    def _get_function_declarations(self):
-        """Defines and returns the tool definitions for the model."""
-        return [
-            {
-                "name": "get_weather",
-                "description": "Returns weather information of a place.",
-                "parameters": {
-                    "type": "object",
-                    "properties":{
-                        "place": {"type": "string", "description": "Name of the place"},
-                        "aqi": {"type": "boolean", "description": "True if aqi is asked else False."}
-                    },
-                    "required": ["place", "aqi"]
-                }
-            },
-            {
-                "name": "add_draft",
-                "description": "Adds the draft into drafts",
-                "parameters": {
-                    "type": "object",
-                    "properties":{
-                        "to": {"type": "string", "description": "email address of the reciever"},
-                        "subject": {"type": "string", "description": "subject of the email"},
-                        "body": {"type": "string", "description": "actual body of the email"}
-                    },
-                    "required": ["to", "subject", "body"]
-                }
-            },
-            {
-                "name": "send_email",
-                "description": "sends the email",
-                "parameters": {
-                    "type": "object",
-                    "properties":{
-                        "to": {"type": "string", "description": "email address of the reciever"},
-                        "subject": {"type": "string", "description": "subject of the email"},
-                        "body": {"type": "string", "description": "actual body of the email"}
-                    },
-                    "required": ["to", "subject", "body"]
-                }
-            },
-            {
-                "name": "list_drafts",
-                "description": "returns a list of drafts"
-            },
-            {
-                "name": "update_draft",
-                "description": "Updates a pre-existing draft.",
-                "parameters":{
-                    "type": "object",
-                    "properties":{
-                        "draft_id": {"type": "string", "description": "Id of the draft to be updated."},
-                        "to": {"type": "string", "description": "email address of the reciever"},
-                        "subject": {"type": "string", "description": "subject of the email"},
-                        "body": {"type": "string", "description": "actual body of the email"}
-                    },
-                    "required":["draft_id", "to", "subject", "body"]
-                }
-            }
-        ]
+        return system_prompt
+
+    def _create_config(self):
+        """Caches the system prompt and tools server-side and returns a config referencing the cache.
+
+        Gemini does not allow tools or a system instruction next to cached content, so both live
+        in the cache. If caching is unavailable (e.g. the prompt is below the model's minimum
+        cache size), they are sent with every request instead.
+        """
+        uncached_config = types.GenerateContentConfig(system_instruction=self.system_prompt, tools=[self.tools])
+        self.cache_name = None
+        self.cache_expire_time = None
+        # Rough local estimate (about four characters per token) so small prompts skip a request that would fail.
+        prompt_tokens = (len(self.system_prompt) + len(self.tools.model_dump_json(exclude_none=True))) // 4
+        if prompt_tokens < CACHE_MIN_TOKENS:
+            logger.info(f"System prompt is about {prompt_tokens} tokens, below the {CACHE_MIN_TOKENS} token caching minimum; not caching it.")
+            return uncached_config
+        try:
+            cache = _get_genai_client().caches.create(
+                model=MODEL,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=self.system_prompt,
+                    tools=[self.tools],
+                    ttl=f"{CACHE_TTL_SECONDS}s"
+                )
+            )
+        except (APIError, ClientError) as e:
+            logger.warning(f"Context caching unavailable, sending the system prompt with each request: {e}")
+            return uncached_config
+        self.cache_name = cache.name
+        self.cache_expire_time = cache.expire_time
+        return types.GenerateContentConfig(cached_content=cache.name)
+
+    def _refresh_cache(self):
+        """Extends the cache TTL when it is close to expiring, recreating the cache if it is gone."""
+        if not self.cache_name or not self.cache_expire_time:
+            return
+        if self.cache_expire_time - datetime.now(timezone.utc) > timedelta(minutes=5):
+            return
+        try:
+            cache = _get_genai_client().caches.update(
+                name=self.cache_name,
+                config=types.UpdateCachedContentConfig(ttl=f"{CACHE_TTL_SECONDS}s")
+            )
+            self.cache_expire_time = cache.expire_time
+        except (APIError, ClientError) as e:
+            logger.warning(f"Unable to extend context cache, recreating it: {e}")
+            self.config = self._create_config()
 
     def _get_user_profile(self):
         """Fetches the user's profile using the People API."""
-        creds = authorize()
-        if not creds:
+        people_service = get_service('people', 'v1')
+        if not people_service:
             return "Unable to retrieve user profile."
         try:
-            people_service = build('people', 'v1', credentials=creds)
             user_profile = people_service.people().get(
                 resourceName='people/me',
                 personFields='names,emailAddresses'
             ).execute()
             return user_profile
         except Exception as e:
-            logging.error(f"Error fetching user profile: {e}")
+            logger.error(f"Error fetching user profile: {e}")
             return "Unable to retrieve user profile."
 
-    def _handle_tool_calls(self, tool_calls):
-        """Executes tool calls and appends their responses to the conversation."""
+    async def _await_result(self, handle):
+        """Waits for a pending tool call and returns its result."""
+        task = self.pending_results.get(handle)
+        if task is None:
+            return {"error": f"No pending tool call with handle '{handle}'."}
+        try:
+            # shield keeps the tool running if this wait times out, so it can be awaited again later.
+            result = await asyncio.wait_for(asyncio.shield(task), TOOL_RESULT_TIMEOUT)
+        except TimeoutError:
+            return {"status": "pending", "handle": handle}
+        except Exception as e:
+            self.pending_results.pop(handle, None)
+            return {"error": f"An unexpected error occurred: {e}"}
+        self.pending_results.pop(handle, None)
+        return result
+
+    def _log_pending_failure(self, task):
+        """Retrieves the exception of a finished pending tool so it is logged instead of leaked."""
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Pending tool call failed: {task.exception()}")
+
+    def _discard_pending_results(self):
+        """Cancels tool calls that are still pending and forgets their handles."""
+        for task in self.pending_results.values():
+            task.cancel()
+        self.pending_results.clear()
+
+    def _start_tool(self, call_function, function_args):
+        """Schedules a tool on the event loop, offloading blocking tools to a thread."""
+        # The call happens inside the task so bad arguments (TypeError) surface as a tool error for every tool.
+        async def invoke():
+            if inspect.iscoroutinefunction(call_function):
+                return await call_function(**function_args)
+            return await asyncio.to_thread(call_function, **function_args)
+        return asyncio.ensure_future(invoke())
+
+    async def _batch_tool(self, invocations):
+        """Runs several tool invocations concurrently and returns their results keyed by tool name and position."""
+        try:
+            invocations = [ToolInvocation.model_validate(invocation) for invocation in invocations]
+        except ValidationError as e:
+            return {"error": f"Invalid batch_tool invocations: {e}"}
+
+        results = {}
+        tasks = {}
+        for index, invocation in enumerate(invocations):
+            key = f"{invocation.tool_name}_{index}"
+            call_function = self.available_tools.get(invocation.tool_name)
+            if not call_function or invocation.tool_name in ("batch_tool", "await_result"):
+                results[key] = {"error": f"Tool '{invocation.tool_name}' not found."}
+                continue
+            tasks[key] = self._start_tool(call_function, invocation.arguments)
+
+        responses = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for key, response in zip(tasks, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Tool '{key}' raised an error in batch_tool: {response}")
+                response = {"error": f"An unexpected error occurred: {response}"}
+            results[key] = response
+        return results
+
+    async def _handle_tool_calls_async(self, tool_calls):
+        """Executes tool calls concurrently and appends their responses to the conversation.
+
+        Tools that are still running after TOOL_RESULT_TIMEOUT keep running in the background
+        and are reported to the model as pending, to be collected later through await_result.
+        """
         if not tool_calls:
             return
-        
+
+        calls = []
         for tool_call in tool_calls:
             function_name = tool_call.name
             call_function = self.available_tools.get(function_name)
             if not call_function:
-                logging.warning(f"Tool '{function_name}' not found.")
+                logger.warning(f"Tool '{function_name}' not found.")
+                self._append_tool_response(function_name, {"error": f"Tool '{function_name}' not found."})
                 continue
-            
-            function_args = tool_call.args
-            function_response = call_function(**function_args)
-            
-            logging.info(f"Calling tool: {function_name} with args: {json.dumps(function_args)}")
-            logging.info(f"Tool response: {json.dumps(function_response)}")
-            
-            function_response_part = types.Part.from_function_response(
-                name=tool_call.name,
-                response={"result": function_response}
-            )
-            self.contents.append(types.Content(role="tool", parts=[function_response_part]))
-    
+            calls.append((tool_call, call_function))
+        if not calls:
+            return
+
+        tasks = [
+            self._start_tool(call_function, tool_call.args or {})
+            for tool_call, call_function in calls
+        ]
+        await asyncio.wait(tasks, timeout=TOOL_RESULT_TIMEOUT)
+        # await_result already bounds its own wait; wrapping it in another pending handle would nest handles.
+        awaiting = [
+            task for (tool_call, _), task in zip(calls, tasks)
+            if tool_call.name == "await_result" and not task.done()
+        ]
+        if awaiting:
+            await asyncio.wait(awaiting)
+
+        # Responses are appended in call order so each one lines up with its tool call.
+        for (tool_call, _), task in zip(calls, tasks):
+            if not task.done():
+                handle = uuid.uuid4().hex[:8]
+                self.pending_results[handle] = task
+                task.add_done_callback(self._log_pending_failure)
+                function_response = {"status": "pending", "handle": handle}
+            elif task.exception() is not None:
+                logger.error(f"Tool '{tool_call.name}' raised an error: {task.exception()}")
+                function_response = {"error": f"An unexpected error occurred: {task.exception()}"}
+            else:
+                function_response = task.result()
+
+            # %-style arguments are only formatted if the record is emitted; tool responses can be large.
+            logger.info("Calling tool: %s with args: %s", tool_call.name, tool_call.args)
+            logger.info("Tool response: %s", function_response)
+
+            self._append_tool_response(tool_call.name, function_response)
+
+    def _append_tool_response(self, name, function_response):
+        """Appends a tool result to the conversation as a function response."""
+        function_response_part = types.Part.from_function_response(
+            name=name,
+            response={"result": function_response}
+        )
+        self._append_content(types.Content(role="tool", parts=[function_response_part]))
+
+    def _append_model_turn(self, response):
+        """Appends the model's reply to the conversation, skipping empty (e.g. blocked) replies."""
+        if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+            self._append_content(response.candidates[0].content)
+        else:
+            logger.warning(f"Model returned no content: {response.prompt_feedback or 'no candidates'}")
+
+    def _print_stream(self, text):
+        """Prints streamed answer text as it arrives."""
+        if not self.streamed_text:
+            print("AI: ", end="")
+        self.streamed_text = True
+        print(text, end="", flush=True)
+
+    @staticmethod
+    def _estimate_tokens(content):
+        """Cheaply estimates the token count of one message (about four characters per token)."""
+        size = 0
+        for part in content.parts or []:
+            if part.text:
+                size += len(part.text)
+            if part.function_call:
+                size += len(str(part.function_call.args))
+            if part.function_response:
+                size += len(str(part.function_response.response))
+        return size // 4
+
+    def _append_content(self, content):
+        """Appends a message to the conversation and adds it to the running token estimate."""
+        self.contents.append(content)
+        self.context_tokens += self._estimate_tokens(content)
+
+    def _reset_contents(self, contents):
+        """Replaces the conversation and recomputes the running token estimate."""
+        self.contents = contents
+        self.context_tokens = sum(self._estimate_tokens(content) for content in contents)
+
+    def _prune_contents(self):
+        """Summarizes older turns once the history exceeds CONTEXT_TOKEN_LIMIT.
+
+        The last CONTEXT_KEEP_TURNS turns are kept verbatim so tool calls stay paired with their
+        responses; the system prompt is not part of the history, it lives in the config.
+        """
+        if self.context_tokens <= CONTEXT_TOKEN_LIMIT:
+            return
+        turn_starts = [
+            index for index, content in enumerate(self.contents)
+            if content.role == "user" and any(part.text for part in content.parts or [])
+        ]
+        if len(turn_starts) <= CONTEXT_KEEP_TURNS:
+            return
+        cut = turn_starts[-CONTEXT_KEEP_TURNS]
+        middle = self.contents[:cut]
+        instruction = types.Content(role="user", parts=[types.Part.from_text(
+            text="Summarize the conversation above in a few sentences, keeping names, email addresses, draft ids and pending tool handles."
+        )])
+        try:
+            response = self.runner.run(asyncio.to_thread(_tool_response_with_retry, middle + [instruction]))
+        except (APIError, ClientError) as e:
+            logger.warning(f"Unable to summarize conversation history: {e}")
+            return
+        if not response.text:
+            logger.warning("Summarization returned no text; keeping the conversation history unchanged.")
+            return
+        summary = types.Content(role="user", parts=[types.Part.from_text(
+            text=f"Summary of earlier conversation: {response.text}"
+        )])
+        self._reset_contents([summary] + self.contents[cut:])
+        logger.info(f"Summarized {len(middle)} earlier messages to keep the conversation within {CONTEXT_TOKEN_LIMIT} tokens.")
+
+    def _read_input(self, prompt):
+        """Reads a line of user input while the event loop keeps running pending async tools.
+
+        input() runs on a daemon thread rather than the default executor: close() shuts the
+        executor down and would otherwise block on an unanswered prompt after Ctrl+C.
+        """
+        loop = self.runner.get_loop()
+        future = loop.create_future()
+
+        def resolve(setter, value):
+            if not future.done():
+                setter(value)
+
+        def reader():
+            try:
+                result = (future.set_result, input(prompt))
+            except Exception as e:
+                result = (future.set_exception, e)
+            try:
+                loop.call_soon_threadsafe(resolve, *result)
+            except RuntimeError:
+                # The loop was closed while the prompt was open.
+                pass
+
+        threading.Thread(target=reader, daemon=True).start()
+
+        async def wait_for_input():
+            return await future
+        return self.runner.run(wait_for_input())
+
     def run(self):
         """The main conversational loop."""
-        user_name = self._get_user_profile()
-        if user_name != "Unable to retrieve user profile.":
-            logging.info(f"Agent initialized for user: {self.user_profile['names'][0]['givenName']}")
-            print(f"Hello, {user_name['names'][0]['givenName']}!")
+        if self.user_profile != "Unable to retrieve user profile.":
+            logger.info(f"Agent initialized for user: {self.user_profile['names'][0]['givenName']}")
+            print(f"Hello, {self.user_profile['names'][0]['givenName']}!")
         
         while True:
-            user_query = input("User: ")
+            user_query = self._read_input("User: ")
             if user_query.lower() in ("bye", "exit", "goodbye", "quit"):
-                logging.info(f"Human message: {user_query}. Exiting application.")
+                logger.info(f"Human message: {user_query}. Exiting application.")
                 print("Goodbye! 👋")
                 break
 
-            logging.info("="*30+" Human Message "+"="*27)
-            logging.info(user_query)
+            logger.info("="*30+" Human Message "+"="*27)
+            logger.info(user_query)
             
             try:
-                self.contents.append(("user", user_query))
+                self._append_content(types.Content(role="user", parts=[types.Part.from_text(text=user_query)]))
                 
-                response = _function_calling_with_retry(self.contents, self.config)
-                self.contents.append(response.candidates[0].content)
+                self._refresh_cache()
+                self.streamed_text = False
+                # Model calls run on the agent's event loop so pending tools keep progressing while the model generates.
+                response = self.runner.run(asyncio.to_thread(_function_calling_with_retry, self.contents, self.config, self._print_stream))
+                self._append_model_turn(response)
                 
-                tool_calls = response.function_calls
-                if tool_calls:
-                    self._handle_tool_calls(tool_calls)
-                    response = _tool_response_with_retry(self.contents)
-                    self.contents.append(response.candidates[0].content)
+                # Tools are baked into the cached config, so the model may chain tool calls (e.g. await_result).
+                tool_rounds = 0
+                while response.function_calls and tool_rounds < MAX_TOOL_ROUNDS:
+                    self.runner.run(self._handle_tool_calls_async(response.function_calls))
+                    response = self.runner.run(asyncio.to_thread(_function_calling_with_retry, self.contents, self.config, self._print_stream))
+                    self._append_model_turn(response)
+                    tool_rounds += 1
+
+                if response.function_calls:
+                    # Every function call needs a response or Gemini rejects the history on the next turn.
+                    logger.warning(f"Reached {MAX_TOOL_ROUNDS} tool rounds; asking the model for a final answer.")
+                    for function_call in response.function_calls:
+                        self._append_tool_response(function_call.name, {"error": "Tool call limit reached for this turn."})
+                    response = self.runner.run(asyncio.to_thread(_function_calling_with_retry, self.contents, self.answer_config, self._print_stream))
+                    self._append_model_turn(response)
+
+                if self.streamed_text:
+                    print()
+                else:
+                    print("No answer was returned. Please try rephrasing your request.")
                 
-                logging.info("="*30+" AI Message "+"="*30)
-                logging.info(response.text)
+                # The answer was already streamed to the user, so the full text is only kept at debug level.
+                logger.debug("="*30+" AI Message "+"="*30)
+                logger.debug(response.text)
+
+                self._prune_contents()
             
             except (APIError, ClientError) as e:
-                logging.error(f"API Error: {e}. Resetting conversation state.")
+                logger.error(f"API Error: {e}. Resetting conversation state.")
                 print("An API error occurred. Let's try again from the beginning.")
-                self.contents = self._initialize_contents()
+                self._reset_contents([])
+                self._discard_pending_results()
             except Exception as e:
-                logging.critical(f"An unexpected error occurred in the main loop: {e}", exc_info=True)
+                logger.critical(f"An unexpected error occurred in the main loop: {e}", exc_info=True)
                 print("An unexpected error occurred. Exiting.")
                 break
 
+    def close(self):
+        """Releases the context cache, the event loop and any async clients opened by the tools."""
+        if self.cache_name:
+            try:
+                _get_genai_client().caches.delete(name=self.cache_name)
+            except (APIError, ClientError) as e:
+                logger.warning(f"Unable to delete context cache {self.cache_name}: {e}")
+        self._discard_pending_results()
+        self.runner.run(close_weather_session())
+        self.runner.close()
+
 if __name__ == "__main__":
     agent = Agent()
-    agent.run()
\ No newline at end of file
+    try:
+        agent.run()
+    finally:
+        agent.close()
\ No newline at end of file
@@ -1,21 +1,40 @@
 import os
-import requests
+import asyncio
+import aiohttp
 import json
 import base64
+import re
+import time
 from email.message import EmailMessage
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from tenacity import retry, retry_if_exception_type, wait_exponential, stop_after_attempt
-from .auth import authorize
-from pydantic import BaseModel, EmailStr
+from tenacity import Retrying, retry_if_exception, wait_exponential, stop_after_attempt
+from .auth import get_service
+from dotenv import load_dotenv
+from pydantic import AfterValidator, BaseModel, Json, TypeAdapter
 import logging
-from typing import Optional
+from typing import Annotated, Any, Optional
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+_WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+if not _WEATHER_API_KEY:
+    raise RuntimeError("WEATHER_API_KEY is not set. Add it to the .env file.")
+_WEATHER_URL = "http://api.weatherapi.com/v1/current.json"
+_WEATHER_ATTEMPTS = 2
+
+_EMAIL_PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+def _validate_email(value: str) -> str:
+    if not _EMAIL_PATTERN.fullmatch(value):
+        raise ValueError(f"'{value}' is not a valid email address")
+    return value
+
+Email = Annotated[str, AfterValidator(_validate_email)]
 
 class EmailPayload(BaseModel):
     draft_id: Optional[str|None]
-    to: EmailStr
+    to: Email
     subject: str
     body: str
 
@@ -23,132 +42,207 @@ class PlaceAQI(BaseModel):
     place: str
     aqi: bool
 
-@retry(
+_EMAIL_ADAPTER = TypeAdapter(EmailPayload)
+_PLACE_ADAPTER = TypeAdapter(PlaceAQI)
+
+class ToolInvocation(BaseModel):
+    tool_name: str
+    arguments: Json[dict[str, Any]]
+
+def _build_raw_message(to:str, subject:str, body:str) -> str:
+    """Returns the base64url-encoded RFC 2822 message expected by the Gmail API."""
+    headers = to + subject
+    # Plain ASCII with short lines needs no MIME encoding or header folding, so it can be written directly.
+    if (headers + body).isascii() and "\r" not in headers and "\n" not in headers \
+            and len("Subject: ") + len(subject) <= 998 and len("To: ") + len(to) <= 998 \
+            and all(len(line) <= 998 for line in body.splitlines()):
+        raw = (
+            f"To: {to}\r\nSubject: {subject}\r\nMIME-Version: 1.0\r\n"
+            f"Content-Type: text/plain; charset=\"us-ascii\"\r\nContent-Transfer-Encoding: 7bit\r\n\r\n{body}"
+        ).encode("ascii")
+    else:
+        message = EmailMessage()
+        message.set_content(body)
+        message["To"] = to
+        message["Subject"] = subject
+        raw = message.as_bytes()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def _is_retryable_http_error(error):
+    """Only rate limiting (429) and server errors (5xx) are worth retrying."""
+    return isinstance(error, HttpError) and (error.resp.status == 429 or error.resp.status >= 500)
+
+# Built once and shared by every idempotent Gmail call.
+_GMAIL_RETRY = Retrying(
     stop=stop_after_attempt(2),
     wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type((requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+    retry=retry_if_exception(_is_retryable_http_error),
+    reraise=True
 )
-def get_weather(place:str, aqi:bool) -> dict:
+
+def _execute_with_retry(request):
+    """Executes an idempotent Gmail API request (or batch), retrying on 429 and 5xx errors.
+
+    Not for sends or draft creation: a retry after Gmail accepted the request would duplicate it.
+    """
+    for attempt in _GMAIL_RETRY:
+        with attempt:
+            result = request.execute()
+    return result
+
+# Google recommends at most 50 requests per Gmail batch to stay under per-user concurrency limits.
+_GMAIL_BATCH_SIZE = 50
+_GMAIL_BATCH_ATTEMPTS = 2
+
+def _batch_get_drafts(service, draft_ids):
+    """Fetches drafts in batches of _GMAIL_BATCH_SIZE, in the order of draft_ids.
+
+    Sub-requests that fail with 429 or 5xx are retried in a later batch; drafts that still
+    cannot be fetched are returned as {"id": ..., "error": ...} entries instead of failing the listing.
+    """
+    results = {}
+    pending = list(draft_ids)
+    for attempt in range(_GMAIL_BATCH_ATTEMPTS):
+        if attempt:
+            time.sleep(1)
+        failed = {}
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                failed[request_id] = exception
+            else:
+                results[request_id] = response
+
+        for start in range(0, len(pending), _GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=_collect)
+            for draft_id in pending[start:start + _GMAIL_BATCH_SIZE]:
+                batch.add(service.users().drafts().get(userId = "me", id = draft_id), request_id=draft_id)
+            _execute_with_retry(batch)
+        for draft_id, error in failed.items():
+            logger.warning(f"Failed to fetch draft {draft_id}: {error}")
+            results[draft_id] = {"id": draft_id, "error": f"Failed to fetch draft: {error}"}
+        pending = [draft_id for draft_id, error in failed.items() if _is_retryable_http_error(error)]
+        if not pending:
+            break
+    return [results[draft_id] for draft_id in draft_ids]
+
+def _get_gmail_service():
+    """Returns the shared Gmail service, rebuilt only when the credentials are replaced."""
+    return get_service("gmail", "v1")
+
+_WEATHER_SESSION = None
+
+def _get_weather_session():
+    """Returns the shared aiohttp session, creating it lazily on the agent's event loop."""
+    global _WEATHER_SESSION
+    if _WEATHER_SESSION is None or _WEATHER_SESSION.closed:
+        # Keep idle connections around between chat turns so the TCP handshake is paid once.
+        connector = aiohttp.TCPConnector(limit=20, limit_per_host=10, keepalive_timeout=60)
+        _WEATHER_SESSION = aiohttp.ClientSession(connector=connector)
+    return _WEATHER_SESSION
+
+async def close_weather_session():
+    """Closes the shared aiohttp session, if one was opened."""
+    global _WEATHER_SESSION
+    if _WEATHER_SESSION is not None and not _WEATHER_SESSION.closed:
+        await _WEATHER_SESSION.close()
+    _WEATHER_SESSION = None
+
+async def _fetch_weather(place:str, is_aqi:str) -> dict:
+    session = _get_weather_session()
+    async with session.get(
+        url=_WEATHER_URL,
+        params={"key": _WEATHER_API_KEY, "q": place, "aqi": is_aqi},
+        timeout=aiohttp.ClientTimeout(total=5)
+    ) as result:
+        if result.status >= 400:
+            logger.error(f"Weather API HTTP Error: {result.status} - {await result.text()}")
+            return {"error": "Failed to retrieve weather data due to an HTTP error."}
+        return await result.json()
+
+async def get_weather(place:str, aqi:bool) -> dict:
     try:  
-        PlaceAQI(place=place, aqi=aqi)
+        _PLACE_ADAPTER.validate_python({"place": place, "aqi": aqi})
         if not aqi:
             is_aqi = "no"
         else:
             is_aqi = "yes"
-        result = requests.get(
-            url=f"http://api.weatherapi.com/v1/current.json?key={os.getenv('WEATHER_API_KEY')}&q={place}&aqi={is_aqi}",
-            timeout=5
-        )
-        result.raise_for_status() 
-        return result.json()
-    except requests.exceptions.HTTPError as e:
-        logging.error(f"Weather API HTTP Error: {e.response.status_code} - {e.response.text}")
-        return {"error": "Failed to retrieve weather data due to an HTTP error."}
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Weather API Request Exception: {e}")
+        # Retried inline: a shared AsyncRetrying would mix state between concurrent weather calls.
+        for attempt in range(_WEATHER_ATTEMPTS):
+            try:
+                return await _fetch_weather(place, is_aqi)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == _WEATHER_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Weather API request failed, retrying: {e}")
+                await asyncio.sleep(1)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Weather API Request Exception: {e}")
         return {"error": "Failed to connect to the weather service."}
 
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type(HttpError)
-)
 def add_draft(to:str, subject:str, body:str) -> dict:
     try:
-        EmailPayload(draft_id=None, to=to, subject=subject, body=body)
+        _EMAIL_ADAPTER.validate_python({"draft_id": None, "to": to, "subject": subject, "body": body})
         
-        creds = authorize()
-        service = build("gmail", "v1", credentials=creds)
-        message = EmailMessage()
-        message.set_content(body)
-        message["To"] = to
-        message["Subject"] = subject
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        service = _get_gmail_service()
+        encoded_message = _build_raw_message(to, subject, body)
         create_message = {"message": {"raw": encoded_message}}
         draft = service.users().drafts().create(userId="me", body=create_message).execute()
-        logging.info(f"Draft created with ID: {draft.get('id')}")
+        logger.info(f"Draft created with ID: {draft.get('id')}")
         return draft
     except HttpError as error:
-        logging.error(f"An HTTP error occurred while adding a draft: {error}")
+        logger.error(f"An HTTP error occurred while adding a draft: {error}")
         return {"error": f"Failed to add draft: {error}"}
     except Exception as e:
-        logging.error(f"An unexpected error occurred while adding a draft: {e}")
+        logger.error(f"An unexpected error occurred while adding a draft: {e}")
         return {"error": f"An unexpected error occurred: {e}"}
 
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type(HttpError)
-)
 def send_email(to:str, subject:str, body:str) -> dict:
     try:
-        EmailPayload(draft_id=None, to=to, subject=subject, body=body)
+        _EMAIL_ADAPTER.validate_python({"draft_id": None, "to": to, "subject": subject, "body": body})
         
-        creds = authorize()
-        service = build("gmail", "v1", credentials=creds)
-        message = EmailMessage()
-        message.set_content(body)
-        message["To"] = to
-        message["Subject"] = subject
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        service = _get_gmail_service()
+        encoded_message = _build_raw_message(to, subject, body)
         create_message = {"raw": encoded_message}
         sent_message = service.users().messages().send(userId="me", body=create_message).execute()
-        logging.info(f"Email sent with ID: {sent_message.get('id')}")
+        logger.info(f"Email sent with ID: {sent_message.get('id')}")
         return sent_message
     except HttpError as error:
-        logging.error(f"An HTTP error occurred while sending an email: {error}")
+        logger.error(f"An HTTP error occurred while sending an email: {error}")
         return {"error": f"Failed to send email: {error}"}
     except Exception as e:
-        logging.error(f"An unexpected error occurred while sending an email: {e}")
+        logger.error(f"An unexpected error occurred while sending an email: {e}")
         return {"error": f"An unexpected error occurred: {e}"}
 
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type(HttpError)
-)
 def update_draft(draft_id:str, to:str, subject:str, body:str):
     try:
-        EmailPayload(draft_id=draft_id,to=to, subject=subject, body=body)
+        _EMAIL_ADAPTER.validate_python({"draft_id": draft_id, "to": to, "subject": subject, "body": body})
         
-        creds = authorize()
-        service = build("gmail", "v1", credentials=creds)
-        message = EmailMessage()
-        message.set_content(body)
-        message["To"] = to
-        message["Subject"] = subject
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        service = _get_gmail_service()
+        encoded_message = _build_raw_message(to, subject, body)
         create_message = {"message": {"raw": encoded_message}}
-        updated_draft = service.users().drafts().update(userId = "me", id=draft_id, body=create_message).execute()
-        logging.info(f"Draft updated with ID: {updated_draft.get('id')}")
+        updated_draft = _execute_with_retry(service.users().drafts().update(userId = "me", id=draft_id, body=create_message))
+        logger.info(f"Draft updated with ID: {updated_draft.get('id')}")
         return updated_draft
     except HttpError as error:
-        logging.error(f"An HTTP error occurred while updating the draft: {error}")
+        logger.error(f"An HTTP error occurred while updating the draft: {error}")
         return {"error": f"Failed to update the draft: {error}"}
     except Exception as e:
-        logging.error(f"An unexpected error occurred while updating the draft: {e}")
+        logger.error(f"An unexpected error occurred while updating the draft: {e}")
         return {"error": f"An unexpected error occurred: {e}"}
 
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_exponential(multiplier=1, max=60, min=1),
-    retry=retry_if_exception_type((HttpError))
-)
 def list_drafts():
     try:
-        creds = authorize()
-        service = build("gmail", "v1", credentials=creds)
-        results = service.users().drafts().list(userId = "me").execute()
+        service = _get_gmail_service()
+        results = _execute_with_retry(service.users().drafts().list(userId = "me"))
         list_drafts = results.get("drafts", [])
-        drafts = []
-        for draft in list_drafts:
-            draft_content = service.users().drafts().get(userId = "me", id = draft["id"]).execute()
-            drafts.append(draft_content)
-        logging.info(f"Successfully retrieved {len(drafts)} drafts.")
+        drafts = _batch_get_drafts(service, [draft["id"] for draft in list_drafts])
+        failed = sum(1 for draft in drafts if "error" in draft)
+        logger.info(f"Successfully retrieved {len(drafts) - failed} drafts ({failed} failed).")
         return drafts
     except HttpError as error:
-        logging.error(f"An HTTP error occurred while listing drafts: {error}")
+        logger.error(f"An HTTP error occurred while listing drafts: {error}")
         return [{"error": f"Failed to list drafts: {error}"}]
     except Exception as e:
-        logging.error(f"An unexpected error occurred while listing drafts: {e}")
+        logger.error(f"An unexpected error occurred while listing drafts: {e}")
         return [{"error": f"An unexpected error occurred: {e}"}]
\ No newline at end of file